@@ -4,15 +4,24 @@ Bare minimum MCP server for financial data storage and RAG queries.
 Usage: uv run my_finance_mcp.py
 """
 
+import hashlib
 import json
 import os
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+import sys
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 
 import chromadb
 from mcp.server.fastmcp import FastMCP
-import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib codec
+    orjson = None
 
 # Initialize FastMCP server
 mcp = FastMCP("my-finance")
@@ -20,25 +29,174 @@ mcp = FastMCP("my-finance")
 # Persistent storage paths
 DATA_DIR = Path(os.environ.get("MY_FINANCE_MCP_DIR", Path.home() / ".my_finance_mcp"))
 DB_PATH = DATA_DIR / "financial_data"
-JSON_FILE = DATA_DIR / "transactions.json"
+JSON_FILE = DATA_DIR / "transactions.json"  # legacy single-document ledger
+TRANSACTIONS_JSONL = DATA_DIR / "transactions.jsonl"
 DB_PATH.mkdir(parents=True, exist_ok=True)
 
+# Maximum number of transactions sent to ChromaDB per add call
+CHROMA_BATCH_SIZE = max(1, int(os.environ.get("MY_FINANCE_MCP_BATCH_SIZE", 500)))
+
+# Buffer size for streaming ledger reads and appends (default is 8 KiB)
+LEDGER_BUFFER_SIZE = 1 << 17
+
+# Parsed ledger keyed by the file's (st_mtime_ns, st_size); callers must not mutate it
+_cache: Optional[Tuple[Tuple[int, int], List[Dict[str, Any]]]] = None
+
+# Content hash counts of the ledger rows, keyed the same way and rebuilt when it changes
+_hash_cache: Optional[Tuple[Tuple[int, int], Counter[str]]] = None
+
+# Ledger-only bookkeeping fields left out of list_transactions results
+_HIDDEN_FIELDS = frozenset({"_id", "category_lc"})
+
 # Helper utilities
 
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def _loads(data: bytes) -> Any:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _encode_line(txn: Dict[str, Any]) -> bytes:
+    return _dumps(txn) + b"\n"
+
+
+def _encode_lines(transactions: List[Dict[str, Any]]) -> bytes:
+    return b"".join(_encode_line(txn) for txn in transactions)
+
+
+def _intern_category(txn: Dict[str, Any]) -> None:
+    """Intern a row's category and set its category_lc, in place."""
+    category = txn.get("category")
+    if isinstance(category, str):
+        txn["category"] = category = sys.intern(category)
+    category_lc = txn.get("category_lc")
+    if not isinstance(category_lc, str):
+        category_lc = str(category or "").lower()
+    txn["category_lc"] = sys.intern(category_lc)
+
+
+def _ledger_stamp() -> Optional[Tuple[int, int]]:
+    try:
+        st = TRANSACTIONS_JSONL.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
 def _load_transactions() -> List[Dict[str, Any]]:
-    if JSON_FILE.exists():
-        with JSON_FILE.open("r") as f:
+    global _cache
+    stamp = _ledger_stamp()
+    if stamp is None:
+        _cache = None
+        return []
+    if _cache is not None and _cache[0] == stamp:
+        return _cache[1]
+    transactions = []
+    with TRANSACTIONS_JSONL.open("rb", buffering=LEDGER_BUFFER_SIZE) as f:
+        for line in f:
+            if not line.strip():
+                continue
             try:
-                return json.load(f)
+                transactions.append(_loads(line))
             except json.JSONDecodeError:
-                return []
-    return []
+                # Skip a torn or corrupted line rather than losing the whole ledger
+                continue
+    # Share category strings across rows; rows stored before category_lc
+    # was persisted get it filled in here
+    for txn in transactions:
+        _intern_category(txn)
+    _cache = (stamp, transactions)
+    return transactions
 
 
 def _save_transactions(transactions: List[Dict[str, Any]]) -> None:
-    JSON_FILE.parent.mkdir(parents=True, exist_ok=True)
-    with JSON_FILE.open("w") as f:
-        json.dump(transactions, f, indent=2)
+    """Rewrite the whole ledger; only needed when rows are removed."""
+    global _cache
+    TRANSACTIONS_JSONL.parent.mkdir(parents=True, exist_ok=True)
+    # Encode up front so the ledger is flushed in one buffered write
+    TRANSACTIONS_JSONL.write_bytes(_encode_lines(transactions))
+    _cache = (_ledger_stamp(), list(transactions))
+
+
+def _append_transactions(transactions: List[Dict[str, Any]]) -> None:
+    """Append new rows to the ledger without touching existing ones."""
+    global _cache
+    TRANSACTIONS_JSONL.parent.mkdir(parents=True, exist_ok=True)
+    # Only extend the cache if it still matches the file we are appending to
+    cached = _cache[1] if _cache is not None and _cache[0] == _ledger_stamp() else None
+    with TRANSACTIONS_JSONL.open("ab", buffering=LEDGER_BUFFER_SIZE) as f:
+        f.write(_encode_lines(transactions))
+    if cached is None:
+        _cache = None
+    else:
+        cached.extend(transactions)
+        _cache = (_ledger_stamp(), cached)
+
+
+def _legacy_delete_filter(txn: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Match a row stored without an _id on date, amount and description only."""
+    conditions = [{key: txn[key]} for key in ("date", "amount", "description") if key in txn]
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def _migrate_legacy_ledger() -> None:
+    """Convert an old transactions.json ledger to JSON Lines, once."""
+    global _cache
+    if TRANSACTIONS_JSONL.exists() or not JSON_FILE.exists():
+        return
+    try:
+        transactions = _loads(JSON_FILE.read_bytes())
+    except json.JSONDecodeError:
+        transactions = []
+    _save_transactions(transactions)
+    _cache = None  # force a reparse so old rows get their category_lc filled in
+    JSON_FILE.replace(JSON_FILE.with_name(JSON_FILE.name + ".bak"))
+
+
+def _txn_hash(txn: Dict[str, Any]) -> str:
+    # Normalise so re-extracted rows match (e.g. amount -5 vs -5.0)
+    amount = txn.get("amount")
+    try:
+        amount = float(amount)
+    except (TypeError, ValueError):
+        amount = str(amount).strip()
+    date = str(txn.get("date") or "").strip()
+    description = str(txn.get("description") or "").strip()
+    key = f"{date}|{amount}|{description}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def _stored_hashes() -> Counter[str]:
+    """Count of ledger rows per content hash, recomputed only when the file changes."""
+    global _hash_cache
+    transactions = _load_transactions()
+    stamp = _ledger_stamp()
+    if _hash_cache is None or _hash_cache[0] != stamp:
+        _hash_cache = (stamp, Counter(_txn_hash(txn) for txn in transactions))
+    return _hash_cache[1]
+
+
+def _persist_new_rows(transactions: List[Dict[str, Any]], new_hashes: List[str]) -> None:
+    """Append rows to the ledger, then record their hashes."""
+    global _hash_cache
+    hashes = _stored_hashes()
+    _append_transactions(transactions)
+    hashes.update(new_hashes)
+    _hash_cache = (_ledger_stamp(), hashes)
+
+
+_migrate_legacy_ledger()
 
 # Global data
 chroma_client = chromadb.PersistentClient(path=str(DB_PATH))
@@ -60,33 +218,69 @@ def store_transactions(transactions: List[Dict[str, Any]]) -> str:
             - description: Transaction description (string)
             - category: Transaction category (string, optional, e.g. "Food", "Transport", "Bills")
     
+    Transactions with the same date, amount and description as one already stored
+    are skipped, so re-importing the same statement does not duplicate it. Repeats
+    beyond the number already stored (e.g. an extra identical purchase) are kept.
+    
     Returns:
-        Success message with count of stored transactions
+        Success message with count of stored and skipped transactions
     """
-    # Store in ChromaDB
-    ids = []
-    documents = []
-    metadatas = []
+    # Skip as many copies of each row as the ledger already holds
+    stored_hashes = _stored_hashes()
+    seen: Counter[str] = Counter()
+    new_hashes: List[str] = []
+    new_transactions: List[Dict[str, Any]] = []
+    for txn in transactions:
+        h = _txn_hash(txn)
+        seen[h] += 1
+        if seen[h] > stored_hashes[h]:
+            new_hashes.append(h)
+            new_transactions.append(txn)
+    skipped = len(transactions) - len(new_transactions)
+    transactions = new_transactions
+    if not transactions:
+        return f"No new transactions to store ({skipped} duplicates skipped)"
     
-    for i, txn in enumerate(transactions):
-        txn_id = f"txn_{datetime.now().timestamp()}_{i}"
-        doc = f"Date: {txn.get('date')} Amount: {txn.get('amount')} Description: {txn.get('description')} Category: {txn.get('category', 'unknown')}"
-        
-        ids.append(txn_id)
-        documents.append(doc)
-        metadatas.append(txn)
-    
-    collection.add(
-        ids=ids,
-        documents=documents,
-        metadatas=metadatas
-    )
+    # Store in ChromaDB
+    # A per-call uuid keeps ids unique even when two calls share a clock reading
+    batch_id = uuid.uuid4().hex
+    ids = [f"txn_{batch_id}_{i}" for i in range(len(transactions))]
+    documents = [
+        f"Date: {txn.get('date')} Amount: {txn.get('amount')} Description: {txn.get('description')} Category: {txn.get('category', 'unknown')}"
+        for txn in transactions
+    ]
+    # Persist the Chroma id with each row so deletes can target it directly,
+    # and a lowercased category so list filters need no per-row lower()
+    for txn_id, txn in zip(ids, transactions):
+        txn["_id"] = txn_id
+        _intern_category(txn)
+    # category_lc only serves the ledger's list filter, so keep it out of Chroma
+    metadatas = [{k: v for k, v in txn.items() if k != "category_lc"} for txn in transactions]
     
-    # Also save to JSON file
-    existing = _load_transactions()
-    existing.extend(transactions)
-    _save_transactions(existing)
+    # Nothing is written to the ledger or marked as stored until every
+    # Chroma batch has succeeded
+    added: List[str] = []
+    try:
+        for start in range(0, len(ids), CHROMA_BATCH_SIZE):
+            end = start + CHROMA_BATCH_SIZE
+            collection.add(
+                ids=ids[start:end],
+                documents=documents[start:end],
+                metadatas=metadatas[start:end]
+            )
+            added.extend(ids[start:end])
+        _persist_new_rows(transactions, new_hashes)
+    except Exception:
+        # Roll back earlier batches so a retry is not skipped as a duplicate
+        if added:
+            try:
+                collection.delete(ids=added)
+            except Exception:
+                pass
+        raise
     
+    if skipped:
+        return f"Stored {len(transactions)} transactions successfully ({skipped} duplicates skipped)"
     return f"Stored {len(transactions)} transactions successfully"
 
 
@@ -115,8 +309,7 @@ def query_financial_history(query: str) -> str:
     
     # Create summary
     if found_transactions:
-        df = pd.DataFrame(found_transactions)
-        total_amount = df['amount'].sum() if 'amount' in df.columns else 0
+        total_amount = sum(float(txn.get('amount') or 0) for txn in found_transactions)
         count = len(found_transactions)
         
         response = f"Found {count} relevant transactions.\n"
@@ -145,18 +338,26 @@ def list_transactions(limit: int = 20, offset: int = 0, category: Optional[str]
     Returns:
         Dictionary containing total count, pagination info, and transactions with index field
     """
+    if limit < 0 or offset < 0:
+        raise ValueError("limit and offset must be non-negative.")
+
     transactions = _load_transactions()
+    category_lower = category.lower() if category else None
 
-    indexed: List[Dict[str, Any]] = []
-    for idx, txn in enumerate(transactions):
-        if category and str(txn.get("category", "")).lower() != category.lower():
-            continue
-        entry = dict(txn)
-        entry["index"] = idx
-        indexed.append(entry)
+    def _matches(txn: Dict[str, Any]) -> bool:
+        return category_lower is None or txn.get("category_lc") == category_lower
 
-    total = len(indexed)
-    sliced = indexed[offset: offset + limit]
+    # Only copy the rows inside the requested window
+    window = islice(
+        ((idx, txn) for idx, txn in enumerate(transactions) if _matches(txn)),
+        offset,
+        offset + limit,
+    )
+    sliced = [
+        {**{k: v for k, v in txn.items() if k not in _HIDDEN_FIELDS}, "index": idx}
+        for idx, txn in window
+    ]
+    total = len(transactions) if category_lower is None else sum(1 for txn in transactions if _matches(txn))
 
     return {
         "total": total,
@@ -201,28 +402,41 @@ def delete_transactions(indices: Optional[List[int]] = None, delete_all: bool =
         raise ValueError("Provide indices to delete or set delete_all=True.")
 
     indices_set = set(indices)
-    remaining: List[Dict[str, Any]] = []
-    removed: List[Dict[str, Any]] = []
-
-    for idx, txn in enumerate(transactions):
-        if idx in indices_set:
-            removed.append(txn)
-        else:
-            remaining.append(txn)
+    removed = [transactions[idx] for idx in sorted(indices_set) if 0 <= idx < len(transactions)]
 
     if not removed:
         return "No transactions matched the provided indices."
 
+    remaining = [txn for idx, txn in enumerate(transactions) if idx not in indices_set]
     _save_transactions(remaining)
 
-    # Remove matching entries from ChromaDB using metadata filters
-    for txn in removed:
-        metadata_filter = {k: v for k, v in txn.items() if isinstance(k, str)}
+    # Remove matching entries from ChromaDB in one call by their stored ids
+    ids_to_delete = [txn["_id"] for txn in removed if "_id" in txn]
+    if ids_to_delete:
+        try:
+            collection.delete(ids=ids_to_delete)
+        except Exception:
+            # If id-based delete fails, ignore but keep JSON consistent
+            pass
+
+    # Rows stored before ids were persisted fall back to metadata filters
+    metadata_filters = [
+        metadata_filter
+        for metadata_filter in (_legacy_delete_filter(txn) for txn in removed if "_id" not in txn)
+        if metadata_filter is not None
+    ]
+
+    def _delete_where(metadata_filter: Dict[str, Any]) -> None:
         try:
             collection.delete(where=metadata_filter)
         except Exception:
             # If metadata-based delete fails, ignore but keep JSON consistent
-            continue
+            pass
+
+    if metadata_filters:
+        # Each delete is a separate Chroma round-trip; overlap them
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(_delete_where, metadata_filters))
 
     return f"Deleted {len(removed)} transactions."
 